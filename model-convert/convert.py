@@ -4,7 +4,8 @@ and uploads the result back to the same HuggingFace repo.
 
 Uses ORTModelForSeq2SeqLM (recommended Python API) which handles
 the large model split correctly (encoder + decoder + decoder_with_past).
-Then applies int8 dynamic quantization for browser/CPU use.
+Then writes an fp16 copy (for WebGPU) and applies int8 dynamic and
+int4 weight-only quantization for browser/CPU use.
 
 Usage:
     cd model-convert
@@ -13,8 +14,13 @@ Usage:
 """
 
 import glob
+import itertools
+import multiprocessing
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from quantize_common import model_size, quantize_int8, quantize_q4, quantize_workers
 
 MODEL_ID = "leks-forever/nllb-200-distilled-600M-v1"
 EXPORT_DIR = "./onnx_export"
@@ -42,34 +48,94 @@ def main() -> None:
     # Save ONNX files immediately after export (before anything else can fail)
     ort_model.save_pretrained(onnx_dir)
     print(f"  Saved ONNX files to {onnx_dir}/")
-
-    # Step 3: Quantize each ONNX file to int8 (_quantized.onnx)
+    # Everything below works from the files on disk; free the torch model
+    # and the three ORT sessions before the memory-hungry quantize steps.
+    del ort_model
+
+    # Build the file lists once; later steps append their outputs to them.
+    fp32_files = [f for f in sorted(glob.glob(f"{onnx_dir}/*.onnx"))
+                  if "inferred" not in os.path.basename(f)]
+    fp16_files = []
+    quantized_files = []
+    q4_files = []
+
+    # Step 3: Convert each ONNX file to fp16 (_fp16.onnx)
+    # transformers.js dtype='fp16' loads files with _fp16 suffix. IO stays
+    # fp32 so the JS pipeline needs no changes.
+    print(f"\n==> Converting to fp16...")
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    for src in fp32_files:
+        dst = os.path.splitext(src)[0] + "_fp16.onnx"
+        print(f"  {os.path.basename(src)} -> {os.path.basename(dst)}")
+        model = onnx.load(src, load_external_data=True)
+        # onnx shape inference cannot handle in-memory models over 2 GB
+        model_fp16 = convert_float_to_float16(
+            model, keep_io_types=True,
+            disable_shape_infer=model_size(src) >= 2**31,
+        )
+        del model
+        onnx.save_model(model_fp16, dst,
+                        save_as_external_data=True,
+                        all_tensors_to_one_file=True,
+                        location=os.path.basename(dst) + "_data")
+        del model_fp16
+        fp16_files.append(dst)
+
+    # Step 4: Quantize each fp32 ONNX file to int8 (_quantized.onnx)
     # transformers.js dtype='q8' loads files with _quantized suffix.
+    # Each file is an independent CPU-bound pass, so run them in parallel.
     print(f"\n==> Quantizing to int8 (dynamic quantization)...")
-    from onnxruntime.quantization import quantize_dynamic, QuantType
-
-    source_files = sorted(glob.glob(f"{onnx_dir}/*.onnx"))
-    for src in source_files:
+    jobs = []
+    for src in fp32_files:
         stem = os.path.basename(src).replace(".onnx", "")
         dst = os.path.join(onnx_dir, f"{stem}_quantized.onnx")
         print(f"  {os.path.basename(src)} -> {os.path.basename(dst)}")
-        quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+        jobs.append((src, dst))
+        quantized_files.append(dst)
+
+    # spawn, not fork: torch and onnxruntime keep thread pools alive in this
+    # process, and forking a multi-threaded process can deadlock the child.
+    with ProcessPoolExecutor(max_workers=quantize_workers(len(jobs)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(quantize_int8, src, dst) for src, dst in jobs]
+        wait(futures)
+    for fut in futures:
+        fut.result()  # re-raise any worker failure before uploading
+
+    # Step 5: 4-bit weight-only quantization (_q4.onnx)
+    # MatMul and embedding Gather weights at 4 bits plus per-block scales,
+    # so smaller than int8; the JS client can pick q4 or q8 based on device RAM.
+    print(f"\n==> Quantizing to int4 (weight-only, MatMulNBits + GatherBlockQuantized)...")
+    for src in fp32_files:
+        dst = os.path.splitext(src)[0] + "_q4.onnx"
+        print(f"  {os.path.basename(src)} -> {os.path.basename(dst)}")
+        if not os.path.exists(dst):
+            quantize_q4(src, dst)
+        q4_files.append(dst)
 
-    # Step 4: Upload all ONNX files to HuggingFace (inside onnx/ subfolder)
+    # Step 6: Upload all ONNX files to HuggingFace (inside onnx/ subfolder)
+    # One commit; files are hashed and uploaded concurrently. Quantized
+    # files go first (smaller, so progress shows up early), then fp32, fp16.
     print(f"\n==> Uploading ONNX files to {MODEL_ID}/onnx/ ...")
-    from huggingface_hub import HfApi
+    from huggingface_hub import HfApi, CommitOperationAdd
     api = HfApi()
 
-    all_onnx = sorted(glob.glob(f"{onnx_dir}/*.onnx"))
-    for path in all_onnx:
-        fname = os.path.basename(path)
-        print(f"  Uploading onnx/{fname} ...")
-        api.upload_file(
-            path_or_fileobj=path,
-            path_in_repo=f"onnx/{fname}",
-            repo_id=MODEL_ID,
-            repo_type="model",
-        )
+    operations = []
+    for path in itertools.chain(q4_files, quantized_files, fp32_files, fp16_files):
+        for p in (path, path + "_data"):
+            if os.path.exists(p):
+                operations.append(CommitOperationAdd(
+                    path_in_repo=f"onnx/{os.path.basename(p)}",
+                    path_or_fileobj=p,
+                ))
+    api.create_commit(
+        repo_id=MODEL_ID,
+        repo_type="model",
+        operations=operations,
+        commit_message="Upload ONNX files",
+    )
 
     print(f"\n==> Done!")
     print(f"    https://huggingface.co/{MODEL_ID}/tree/main/onnx")
@@ -1,10 +1,14 @@
 """
 Merges decoder_model.onnx + decoder_with_past_model.onnx into
-decoder_model_merged.onnx, quantizes it to int8, and uploads to HF.
+decoder_model_merged.onnx, quantizes it to int8 and int4, and uploads to HF.
 """
+import glob
 import os
 import sys
-import glob
+
+from merge_common import (link_data_file, load_graph_lazy, name_based_dedup,
+                          quantize_merged, upload_deduplicated)
+from quantize_common import quantize_q4
 
 MODEL_ID = "leks-forever/nllb-200-distilled-600M-v1"
 ONNX_DIR = "./onnx_export/onnx"
@@ -16,6 +20,7 @@ def log(msg):
 
 def download_if_needed():
     """Download decoder ONNX files from HF if not already present locally."""
+    from concurrent.futures import ThreadPoolExecutor
     from huggingface_hub import hf_hub_download
     needed = [
         "onnx/decoder_model.onnx",
@@ -24,21 +29,28 @@ def download_if_needed():
         "onnx/decoder_with_past_model.onnx_data",
     ]
     os.makedirs(ONNX_DIR, exist_ok=True)
-    for repo_path in needed:
+
+    def _dl(repo_path):
         local = os.path.join(ONNX_DIR, os.path.basename(repo_path))
         if os.path.exists(local):
             log(f"  {os.path.basename(local)} already present, skipping download")
-            continue
+            return
         log(f"  Downloading {repo_path} ...")
-        tmp = hf_hub_download(
+        # Download straight into the export dir (repo_path keeps its onnx/
+        # prefix) instead of copying multi-GB files out of the HF cache.
+        hf_hub_download(
             repo_id=MODEL_ID,
             filename=repo_path,
             repo_type="model",
+            local_dir=os.path.dirname(ONNX_DIR),
         )
-        import shutil
-        shutil.copy(tmp, local)
         log(f"  Saved to {local}")
 
+    # The four files are independent; a single connection leaves most of
+    # the bandwidth unused on the multi-GB .onnx_data files.
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        list(ex.map(_dl, needed))
+
 
 def main():
     from huggingface_hub import login
@@ -48,9 +60,9 @@ def main():
     download_if_needed()
 
     # Step 1: Merge decoder + decoder_with_past into merged decoder
-    # Low-memory strategy: load only graph structure (no weights), patch
-    # numpy_helper.to_array so deduplication never reads from disk, then
-    # symlink the existing decoder_model.onnx_data as the merged data file.
+    # Low-memory strategy: load only graph structure (no weights), deduplicate
+    # initializers by name so merge_decoders never reads from disk, then
+    # hardlink the existing decoder_model.onnx_data as the merged data file.
     # Peak RAM: ~200 MB instead of ~9 GB.
     merged_path = os.path.join(ONNX_DIR, "decoder_model_merged.onnx")
     merged_data_path = os.path.join(ONNX_DIR, "decoder_model_merged.onnx_data")
@@ -59,38 +71,44 @@ def main():
     else:
         log("==> Merging (low-memory, graph-only) ...")
         import onnx
-        import numpy as np
-        import onnx.numpy_helper as nh
         from onnx import TensorProto
+        from optimum.onnx.graph_transformations import merge_decoders
 
-        # Patch to_array: return a hash-based sentinel for external tensors
-        # so same-named tensors compare equal without loading 3 GB from disk.
-        _orig_to_array = nh.to_array
-        def _patched_to_array(tensor, base_dir=""):
-            if getattr(tensor, "data_location", None) == TensorProto.EXTERNAL:
-                return np.array([hash(tensor.name) & 0x7FFFFFFF], dtype=np.int64)
-            return _orig_to_array(tensor, base_dir)
-        nh.to_array = _patched_to_array
+        decoder,    fetch_a = load_graph_lazy(os.path.join(ONNX_DIR, "decoder_model.onnx"))
+        decoder_wp, fetch_b = load_graph_lazy(os.path.join(ONNX_DIR, "decoder_with_past_model.onnx"))
+        log(f"  decoder: {len(decoder.graph.node)} nodes / "
+            f"decoder_with_past: {len(decoder_wp.graph.node)} nodes")
 
         # Must cd into ONNX dir so relative external_data paths resolve
+        # when merge_decoders runs the checker on the merged model
         orig_cwd = os.getcwd()
         os.chdir(ONNX_DIR)
-
-        from optimum.onnx.graph_transformations import merge_decoders
-        decoder    = onnx.load("decoder_model.onnx",    load_external_data=False)
-        decoder_wp = onnx.load("decoder_with_past_model.onnx", load_external_data=False)
-        log(f"  decoder: {len(decoder.graph.node)} nodes / "
-            f"decoder_with_past: {len(decoder_wp.graph.node)} nodes")
-
-        merged = merge_decoders(decoder=decoder, decoder_with_past=decoder_wp,
-                                save_path=None, strict=False)
-        nh.to_array = _orig_to_array  # restore patch
-        os.chdir(orig_cwd)
+        try:
+            with name_based_dedup(fetchers=[fetch_a, fetch_b]):
+                merged = merge_decoders(decoder=decoder, decoder_with_past=decoder_wp,
+                                        save_path=None, strict=False)
+        finally:
+            os.chdir(orig_cwd)
 
         merged.ir_version = 8
         log(f"  Merged: {len(merged.graph.node)} nodes, "
             f"{len(merged.graph.initializer)} initializers")
 
+        # The merged data file is a link to decoder_model.onnx_data, so any
+        # tensor still read from decoder_with_past's file (differing or
+        # with_past-only weights) would pick up the wrong bytes.
+        only_in_b = [
+            t.name for t in merged.graph.initializer
+            if t.data_location == TensorProto.EXTERNAL and any(
+                e.key == "location" and e.value == "decoder_with_past_model.onnx_data"
+                for e in t.external_data)
+        ]
+        if only_in_b:
+            log(f"  ERROR: {len(only_in_b)} tensors are not shared with decoder_model "
+                f"(e.g. {only_in_b[:5]}); run merge_lowmem.py, which builds a "
+                f"combined data file")
+            sys.exit(1)
+
         # Repoint all external_data locations to decoder_model_merged.onnx_data
         for t in merged.graph.initializer:
             if t.data_location == TensorProto.EXTERNAL:
@@ -104,44 +122,54 @@ def main():
         graph_kb = os.path.getsize(merged_path) / 1e3
         log(f"  Saved: decoder_model_merged.onnx ({graph_kb:.0f} kB)")
 
-        # Symlink decoder_model.onnx_data → decoder_model_merged.onnx_data
+        # Link decoder_model.onnx_data → decoder_model_merged.onnx_data
         # (all shared weights stay in place, no 3 GB copy needed)
         if not os.path.exists(merged_data_path):
-            os.symlink(os.path.abspath(os.path.join(ONNX_DIR, "decoder_model.onnx_data")),
-                       merged_data_path)
-            log(f"  Symlinked decoder_model.onnx_data → decoder_model_merged.onnx_data")
+            link_data_file(os.path.join(ONNX_DIR, "decoder_model.onnx_data"), merged_data_path)
+            log(f"  Linked decoder_model.onnx_data → decoder_model_merged.onnx_data")
+
+        # Validate the graph and its external-data references (not the weight
+        # bytes) before the multi-minute quantize step runs against a broken file.
+        try:
+            onnx.checker.check_model(merged_path, full_check=False)
+        except onnx.checker.ValidationError as e:
+            log(f"  ERROR: merged model failed validation: {e}")
+            os.remove(merged_path)  # so the next run redoes the merge
+            sys.exit(1)
+        log("  graph check passed")
 
     # Step 2: Quantize merged decoder
     merged_q_path = os.path.join(ONNX_DIR, "decoder_model_merged_quantized.onnx")
     if os.path.exists(merged_q_path):
         log(f"==> decoder_model_merged_quantized.onnx already exists, skipping quantization")
     else:
-        log("==> Quantizing decoder_model_merged.onnx ...")
-        from onnxruntime.quantization import quantize_dynamic, QuantType
-        quantize_dynamic(merged_path, merged_q_path, weight_type=QuantType.QUInt8)
-        size_mb = os.path.getsize(merged_q_path) / 1e6
-        log(f"  Saved: decoder_model_merged_quantized.onnx ({size_mb:.0f} MB)")
+        quantize_merged(merged_path, merged_q_path)
+
+    # Step 2b: 4-bit weight-only variant for memory-constrained clients
+    merged_q4_path = os.path.join(ONNX_DIR, "decoder_model_merged_q4.onnx")
+    if os.path.exists(merged_q4_path):
+        log("==> decoder_model_merged_q4.onnx already exists, skipping int4 quantization")
+    else:
+        log("==> Quantizing decoder_model_merged.onnx to int4 ...")
+        quantize_q4(merged_path, merged_q4_path)
+        size_mb = (os.path.getsize(merged_q4_path) +
+                   os.path.getsize(merged_q4_path + "_data")) / 1e6
+        log(f"  Saved: decoder_model_merged_q4.onnx ({size_mb:.0f} MB)")
 
-    # Step 3: Upload both files (and any associated .onnx_data)
+    # Step 3: Upload the merged files (and any associated .onnx_data)
     log(f"\n==> Uploading to {MODEL_ID}/onnx/ ...")
     from huggingface_hub import HfApi
     api = HfApi()
 
-    to_upload = []
-    for pattern in [f"{ONNX_DIR}/decoder_model_merged*.onnx", f"{ONNX_DIR}/decoder_model_merged*.onnx_data"]:
-        to_upload.extend(glob.glob(pattern))
-
-    for path in sorted(to_upload):
-        fname = os.path.basename(path)
-        real  = os.path.realpath(path)  # follow symlinks for .onnx_data
-        size_mb = os.path.getsize(real) / 1e6
-        log(f"  Uploading onnx/{fname} ({size_mb:.0f} MB) ...")
-        api.upload_file(
-            path_or_fileobj=real,
-            path_in_repo=f"onnx/{fname}",
-            repo_id=MODEL_ID,
-            repo_type="model",
-        )
+    to_upload = [
+        p for p in sorted(glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx") +
+                          glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx_data"))
+        if ".pre." not in os.path.basename(p)
+    ]
+    upload_deduplicated(api, MODEL_ID, to_upload, known=[
+        os.path.join(ONNX_DIR, "decoder_model.onnx_data"),
+        os.path.join(ONNX_DIR, "decoder_with_past_model.onnx_data"),
+    ])
 
     log("\n==> Done!")
     log(f"    https://huggingface.co/leks-forever/nllb-200-distilled-600M/tree/main/onnx")
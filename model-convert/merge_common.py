@@ -0,0 +1,259 @@
+"""
+Decoder-merge helpers shared by merge_lowmem.py and merge_and_upload.py.
+"""
+import contextlib
+import os
+
+
+def log(msg):
+    print(msg, flush=True)
+
+
+def rename_quantized_data(model_path):
+    """quantize_dynamic(use_external_data_format=True) writes the weights to
+    "<model>.onnx.data"; rename it to "<model>.onnx_data" (the name
+    transformers.js requests) and repoint the graph's references."""
+    import onnx
+    from onnx.external_data_helper import _get_all_tensors, uses_external_data
+    old_path = model_path + ".data"
+    new_path = model_path + "_data"
+    if not os.path.exists(old_path):
+        return
+    model = onnx.load(model_path, load_external_data=False)
+    for t in _get_all_tensors(model):
+        if uses_external_data(t):
+            for e in t.external_data:
+                if e.key == "location":
+                    e.value = os.path.basename(new_path)
+    onnx.save_model(model, model_path, save_as_external_data=False)
+    os.replace(old_path, new_path)
+
+
+def quantize_merged(model_path, merged_q_path):
+    """Shape-infer and quantize the merged decoder at model_path to
+    <merged_q_path> + <merged_q_path>_data."""
+    import onnx
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from onnxruntime.quantization.quant_utils import add_pre_process_metadata
+    log(f"==> Quantizing {os.path.basename(model_path)} ...")
+    # ONNX shape inference only, instead of quant_pre_process: ORT's graph
+    # optimizer cannot write models over 2 GB, and symbolic shape inference
+    # asserts on If branches whose output comes straight from a MatMul
+    # (logits, since lm_head has no bias). The inferred graph is written next
+    # to model_path so it keeps reading the original .onnx_data.
+    pre_path = os.path.splitext(model_path)[0] + ".pre.onnx"
+    try:
+        onnx.shape_inference.infer_shapes_path(model_path, pre_path)
+        pre = onnx.load(pre_path, load_external_data=False)
+        add_pre_process_metadata(pre)
+        onnx.save_model(pre, pre_path, save_as_external_data=False)
+        del pre
+        # Write weights as external data so the quantizer never has to
+        # serialize a >2 GB protobuf. Per-channel 7-bit MatMul weights plus
+        # the embedding Gather, same as quantize_common.quantize_int8.
+        # EnableSubgraph: every MatMul of the merged decoder sits inside one
+        # of the If branches, which quantize_dynamic skips by default.
+        quantize_dynamic(pre_path, merged_q_path, weight_type=QuantType.QUInt8,
+                         per_channel=True, reduce_range=True,
+                         op_types_to_quantize=["MatMul", "Gather"],
+                         use_external_data_format=True,
+                         extra_options={"EnableSubgraph": True})
+    finally:
+        if os.path.exists(pre_path):
+            os.remove(pre_path)
+    rename_quantized_data(merged_q_path)
+    if "MatMulInteger" not in _op_types(onnx.load(merged_q_path, load_external_data=False).graph):
+        os.remove(merged_q_path)
+        os.remove(merged_q_path + "_data")
+        raise RuntimeError(f"{merged_q_path} has no MatMulInteger nodes; "
+                           f"the If branches were not quantized")
+    size_mb = (os.path.getsize(merged_q_path) +
+               os.path.getsize(merged_q_path + "_data")) / 1e6
+    log(f"  Saved: {os.path.basename(merged_q_path)} ({size_mb:.0f} MB)")
+
+
+def _op_types(graph):
+    """Op types used in graph, including inside If/Loop subgraphs."""
+    import onnx
+    ops = set()
+    for node in graph.node:
+        ops.add(node.op_type)
+        for attr in node.attribute:
+            if attr.type == onnx.AttributeProto.GRAPH:
+                ops |= _op_types(attr.g)
+    return ops
+
+
+def load_graph_lazy(path):
+    """Load an ONNX graph without its external data.
+
+    Returns (model, fetch) where fetch(name) gives the raw bytes of an
+    external initializer as a uint8 view into an mmap of its data file, so
+    only the pages actually compared are read from disk.
+    """
+    import mmap
+    import numpy as np
+    import onnx
+    from onnx import TensorProto
+    model = onnx.load(path, load_external_data=False)
+    # Absolute: fetch runs inside merge_decoders, after the caller has
+    # chdir'd into the model directory.
+    base_dir = os.path.dirname(os.path.abspath(path))
+    refs = {}
+    for t in model.graph.initializer:
+        if t.data_location == TensorProto.EXTERNAL:
+            refs[t.name] = {e.key: e.value for e in t.external_data}
+    maps = {}
+
+    def fetch(name):
+        entries = refs[name]
+        loc = entries["location"]
+        if loc not in maps:
+            with open(os.path.join(base_dir, loc), "rb") as f:
+                maps[loc] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = maps[loc]
+        offset = int(entries.get("offset", 0))
+        length = int(entries.get("length", len(mm) - offset))
+        return np.frombuffer(mm, dtype=np.uint8, count=length, offset=offset)
+
+    return model, fetch
+
+
+def find_duplicate_initializers(models, fetchers=None):
+    """Stand-in for optimum's _find_duplicate_initializers that avoids
+    reading weight bytes.
+
+    External tensors are keyed on (data_type, name, dims): decoder and
+    decoder_with_past are exported from the same module, so a shared
+    parameter has the same name in both. Exporter-generated names
+    ("onnx::MatMul_2295", "/model/...") are numbered per graph and may
+    collide with different data, so when `fetchers` (one fetch per model,
+    from load_graph_lazy) is given those collisions are confirmed by
+    comparing bytes. Small inlined tensors are hashed by content, as
+    optimum does.
+    """
+    import hashlib
+    from collections import defaultdict
+    import numpy as np
+    from onnx import TensorProto, numpy_helper
+    duplicates = defaultdict(set)
+    first_seen = {}  # external tensor name -> model index that defined it first
+    for i, model in enumerate(models):
+        for t in model.graph.initializer:
+            dims = tuple(t.dims)
+            if len(dims) == 0 or (len(dims) == 1 and t.data_type in (TensorProto.INT32, TensorProto.INT64)):
+                continue
+            if t.data_location == TensorProto.EXTERNAL:
+                key = f"name:{t.name}"
+                j = first_seen.setdefault(t.name, i)
+                generated = "::" in t.name or t.name.startswith("/")
+                if fetchers and j != i and generated:
+                    if not np.array_equal(fetchers[j](t.name), fetchers[i](t.name)):
+                        key = f"name:{t.name}#{i}"
+            else:
+                key = hashlib.sha512(numpy_helper.to_array(t)).hexdigest()
+            duplicates[(t.data_type, key, dims)].add((t.name, i))
+    return duplicates
+
+
+@contextlib.contextmanager
+def name_based_dedup(fetchers=None):
+    """Make optimum's merge_decoders deduplicate with find_duplicate_initializers."""
+    import functools
+    from optimum.onnx import transformations_utils
+    orig = transformations_utils._find_duplicate_initializers
+    transformations_utils._find_duplicate_initializers = functools.partial(
+        find_duplicate_initializers, fetchers=fetchers)
+    try:
+        yield
+    finally:
+        transformations_utils._find_duplicate_initializers = orig
+
+
+def upload_deduplicated(api, repo_id, paths, known=()):
+    """Upload `paths` to onnx/ in repo_id, sending each distinct file once.
+
+    Paths that are the same file on disk (symlinks or hardlinks) are grouped;
+    the first one is uploaded and the rest are copied server-side with
+    CommitOperationCopy. `known` lists local files that already exist in the
+    repo as onnx/<name>: a group matching one of those is copied from it
+    without uploading anything (e.g. the merged .onnx_data that is just
+    decoder_model.onnx_data under another name). A known file is only
+    trusted if the repo's copy has the same size and sha256; otherwise the
+    merged graph's offsets would point into a stale blob.
+    """
+    from huggingface_hub import CommitOperationAdd, CommitOperationCopy
+
+    def file_id(path):
+        st = os.stat(path)
+        return st.st_dev, st.st_ino
+
+    groups = {}
+    for path in sorted(paths):
+        groups.setdefault(file_id(path), []).append(path)
+
+    # Only known files that are the same file as something being uploaded
+    # can serve as a copy source, so only those get hashed.
+    local = {f"onnx/{os.path.basename(p)}": p for p in known
+             if os.path.exists(p) and file_id(p) in groups}
+    remote = {i.path: i for i in api.get_paths_info(repo_id, list(local))} if local else {}
+    in_repo = {}
+    for repo_path, path in local.items():
+        info = remote.get(repo_path)
+        if info is None:
+            continue
+        if _matches_remote(path, info):
+            in_repo[file_id(path)] = repo_path
+        else:
+            log(f"  {repo_path} on the Hub differs from the local file, not copying from it")
+
+    # Copies resolve their source in the parent revision: copies of files
+    # already in the repo can share the upload commit, copies of files added
+    # by this run need a follow-up commit.
+    operations, late_copies = [], []
+    for fid, group in groups.items():
+        src = in_repo.get(fid)
+        copies = operations
+        if src is None:
+            first = group.pop(0)
+            src = f"onnx/{os.path.basename(first)}"
+            size_mb = os.path.getsize(first) / 1e6
+            log(f"  Uploading {src} ({size_mb:.0f} MB) ...")
+            operations.append(CommitOperationAdd(path_in_repo=src, path_or_fileobj=first))
+            copies = late_copies
+        for path in group:
+            dst = f"onnx/{os.path.basename(path)}"
+            log(f"  Copying {src} -> {dst} (server-side)")
+            copies.append(CommitOperationCopy(src_path_in_repo=src, path_in_repo=dst))
+
+    if operations:
+        api.create_commit(repo_id=repo_id, repo_type="model", operations=operations,
+                          commit_message="Upload merged decoder")
+    if late_copies:
+        api.create_commit(repo_id=repo_id, repo_type="model", operations=late_copies,
+                          commit_message="Copy shared decoder weights")
+
+
+def _matches_remote(path, info):
+    """True if the local file has the size and LFS sha256 of `info` (a
+    RepoFile from get_paths_info). Compares sizes first so a mismatch never
+    hashes a multi-GB file."""
+    import hashlib
+    lfs = getattr(info, "lfs", None)
+    if lfs is None or lfs.size != os.path.getsize(path):
+        return False
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest() == lfs.sha256
+
+
+def link_data_file(src, dst):
+    """Hardlink dst to src so it is a regular file to the uploader and
+    onnx; fall back to a symlink across filesystems or where hardlinks
+    are not supported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
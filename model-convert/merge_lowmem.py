@@ -4,11 +4,14 @@ Loads only the ONNX graph structure (not external weight data),
 merges the graphs, then stitches in the original external data references.
 Peak memory: ~200MB instead of ~6GB.
 """
+import glob
 import os
 import sys
-import glob
 import shutil
 
+from merge_common import (link_data_file, load_graph_lazy, name_based_dedup,
+                          quantize_merged, upload_deduplicated)
+
 MODEL_ID = "leks-forever/nllb-200-distilled-600M-v1"
 ONNX_DIR = "./onnx_export/onnx"
 
@@ -49,8 +52,6 @@ def restore_ext_refs(merged_model, ext_map_a, ext_map_b):
 
 
 def main():
-    import onnx
-    from optimum.onnx.graph_transformations import merge_decoders
     from huggingface_hub import login
     login(token=os.environ.get("HF_TOKEN"))
 
@@ -63,9 +64,13 @@ def main():
     if os.path.exists(merged_path):
         log("==> decoder_model_merged.onnx already exists, skipping merge")
     else:
+        import onnx
+        from onnx import TensorProto
+        from optimum.onnx.graph_transformations import merge_decoders
+
         log("==> Loading decoder graphs (no external data) ...")
-        decoder    = onnx.load(dec_path,    load_external_data=False)
-        decoder_wp = onnx.load(dec_wp_path, load_external_data=False)
+        decoder,    fetch_a = load_graph_lazy(dec_path)
+        decoder_wp, fetch_b = load_graph_lazy(dec_wp_path)
         log(f"  Loaded: {len(decoder.graph.node)} nodes / {len(decoder_wp.graph.node)} nodes")
 
         ext_a = build_ext_map(decoder)
@@ -73,11 +78,19 @@ def main():
         log(f"  External tensors: {len(ext_a)} in decoder, {len(ext_b)} in decoder_with_past")
 
         log("==> Merging graph structures ...")
-        merged = merge_decoders(
-            decoder=decoder,
-            decoder_with_past=decoder_wp,
-            strict=False,
-        )
+        # Must cd into ONNX dir so relative external_data paths resolve
+        # when merge_decoders runs the checker on the merged model
+        orig_cwd = os.getcwd()
+        os.chdir(ONNX_DIR)
+        try:
+            with name_based_dedup(fetchers=[fetch_a, fetch_b]):
+                merged = merge_decoders(
+                    decoder=decoder,
+                    decoder_with_past=decoder_wp,
+                    strict=False,
+                )
+        finally:
+            os.chdir(orig_cwd)
         log(f"  Merged graph: {len(merged.graph.node)} nodes")
 
         log("==> Restoring external data references ...")
@@ -89,8 +102,16 @@ def main():
         # point to decoder_with_past_model.onnx_data.
         #
         # Since NLLB decoder and decoder_with_past share ALL weights,
-        # we only need one .onnx_data file. Verify assumption:
-        only_in_b = set(ext_b.keys()) - set(ext_a.keys())
+        # we only need one .onnx_data file. Verify assumption: collect the
+        # tensors the merged graph still reads from decoder_with_past's file
+        # (by location: merge_decoders renames initializers, and a
+        # same-named tensor may hold different data).
+        only_in_b = {}
+        for t in merged.graph.initializer:
+            if t.data_location == TensorProto.EXTERNAL:
+                entries = {e.key: e.value for e in t.external_data}
+                if entries.get("location") == "decoder_with_past_model.onnx_data":
+                    only_in_b[t.name] = entries
         log(f"  Tensors only in decoder_with_past (not shared): {len(only_in_b)}")
         if only_in_b:
             log(f"  Unique tensors: {list(only_in_b)[:5]}")
@@ -104,37 +125,45 @@ def main():
             dec_data = os.path.join(ONNX_DIR, "decoder_model.onnx_data")
             dec_wp_data = os.path.join(ONNX_DIR, "decoder_with_past_model.onnx_data")
 
-            shutil.copy2(dec_data, merged_data_path)
-            base_offset = os.path.getsize(merged_data_path)
-
-            # Append unique tensors from decoder_with_past_model.onnx_data
-            from onnx.external_data_helper import ExternalDataInfo
-            offset_map = {}  # tensor_name -> new offset in merged file
-            with open(merged_data_path, "ab") as out_f, open(dec_wp_data, "rb") as wp_f:
-                for name in only_in_b:
-                    entries = {e.key: e.value for e in ext_b[name]}
-                    old_offset = int(entries.get("offset", 0))
-                    length = int(entries.get("length", 0))
-                    wp_f.seek(old_offset)
-                    data = wp_f.read(length)
-                    new_offset = base_offset + out_f.tell() - base_offset
-                    out_f.seek(0, 2)  # seek to end
-                    new_offset = out_f.tell()
-                    out_f.write(data)
-                    offset_map[name] = (new_offset, length)
-
-            # Update references in merged model: all point to merged file
+            # A data file left by an earlier shared-weights run is a link to
+            # dec_data; opening it for writing would truncate the original.
+            if os.path.lexists(merged_data_path):
+                os.unlink(merged_data_path)
+            _clone_file(dec_data, merged_data_path)
+
+            # Append unique tensors from decoder_with_past_model.onnx_data.
+            # Copy them in file order so reads stay sequential, and let the
+            # kernel move the bytes instead of buffering them in Python.
+            blocks = sorted(
+                (int(entries.get("offset", 0)), int(entries.get("length", 0)))
+                for entries in only_in_b.values()
+            )
+            offset_map = {}  # offset in decoder_with_past data -> offset in merged file
+            out_fd = os.open(merged_data_path, os.O_WRONLY)
+            wp_fd = os.open(dec_wp_data, os.O_RDONLY)
+            try:
+                cursor = os.lseek(out_fd, 0, os.SEEK_END)
+                for old_offset, length in blocks:
+                    _copy_range(wp_fd, out_fd, old_offset, length)
+                    offset_map[old_offset] = cursor
+                    cursor += length
+            finally:
+                os.close(wp_fd)
+                os.close(out_fd)
+
+            # Update references in merged model: all point to merged file.
+            # merge_decoders renames shared initializers, so match the
+            # decoder_with_past tensors by their old offset, not by name.
             for t in merged.graph.initializer:
-                from onnx import TensorProto
                 if t.data_location == TensorProto.EXTERNAL:
                     entries = {e.key: e.value for e in t.external_data}
                     loc = entries.get("location", "")
                     del t.external_data[:]
-                    if t.name in offset_map:
-                        new_off, new_len = offset_map[t.name]
+                    if loc == "decoder_with_past_model.onnx_data":
+                        new_off = offset_map[int(entries.get("offset", 0))]
                         t.external_data.add().CopyFrom(_kv("location", "decoder_model_merged.onnx_data"))
                         t.external_data.add().CopyFrom(_kv("offset", str(new_off)))
-                        t.external_data.add().CopyFrom(_kv("length", str(new_len)))
+                        t.external_data.add().CopyFrom(_kv("length", entries.get("length", "0")))
                     else:
                         # Keep original offset in decoder_model.onnx_data, just rename
                         for k, v in entries.items():
@@ -142,15 +171,11 @@ def main():
                                 v = "decoder_model_merged.onnx_data"
                             t.external_data.add().CopyFrom(_kv(k, v))
         else:
-            log("  All weights shared — symlinking decoder_model.onnx_data as merged data file")
+            log("  All weights shared — linking decoder_model.onnx_data as merged data file")
             merged_data_path = os.path.join(ONNX_DIR, "decoder_model_merged.onnx_data")
             if not os.path.exists(merged_data_path):
-                os.symlink(
-                    os.path.abspath(os.path.join(ONNX_DIR, "decoder_model.onnx_data")),
-                    merged_data_path,
-                )
+                link_data_file(os.path.join(ONNX_DIR, "decoder_model.onnx_data"), merged_data_path)
             # Patch all external_data references to point to merged data file name
-            from onnx import TensorProto
             for t in merged.graph.initializer:
                 if t.data_location == TensorProto.EXTERNAL:
                     for e in t.external_data:
@@ -162,40 +187,78 @@ def main():
         size_kb = os.path.getsize(merged_path) / 1e3
         log(f"  Saved: decoder_model_merged.onnx ({size_kb:.0f} kB graph + external data)")
 
+        # Validate the graph and its external-data references (not the weight
+        # bytes) before the multi-minute quantize step runs against a broken file.
+        try:
+            onnx.checker.check_model(merged_path, full_check=False)
+        except onnx.checker.ValidationError as e:
+            log(f"  ERROR: merged model failed validation: {e}")
+            os.remove(merged_path)  # so the next run redoes the merge
+            sys.exit(1)
+        log("  graph check passed")
+
     # ---------- Step 2: quantize ----------
     if os.path.exists(merged_q_path):
         log("==> decoder_model_merged_quantized.onnx already exists, skipping")
     else:
-        log("==> Quantizing decoder_model_merged.onnx ...")
-        from onnxruntime.quantization import quantize_dynamic, QuantType
-        quantize_dynamic(merged_path, merged_q_path, weight_type=QuantType.QUInt8)
-        size_mb = os.path.getsize(merged_q_path) / 1e6
-        log(f"  Saved: decoder_model_merged_quantized.onnx ({size_mb:.0f} MB)")
+        quantize_merged(merged_path, merged_q_path)
 
     # ---------- Step 3: upload ----------
     log(f"\n==> Uploading to {MODEL_ID}/onnx/ ...")
     from huggingface_hub import HfApi
     api = HfApi()
-    to_upload = sorted(
-        glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx") +
-        glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx_data")
-    )
-    for path in to_upload:
-        fname = os.path.basename(path)
-        real_path = os.path.realpath(path)  # follow symlinks
-        size_mb = os.path.getsize(real_path) / 1e6
-        log(f"  Uploading onnx/{fname} ({size_mb:.0f} MB) ...")
-        api.upload_file(
-            path_or_fileobj=real_path,
-            path_in_repo=f"onnx/{fname}",
-            repo_id=MODEL_ID,
-            repo_type="model",
-        )
+    to_upload = [
+        p for p in sorted(glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx") +
+                          glob.glob(f"{ONNX_DIR}/decoder_model_merged*.onnx_data"))
+        if ".pre." not in os.path.basename(p)
+    ]
+    upload_deduplicated(api, MODEL_ID, to_upload, known=[
+        os.path.join(ONNX_DIR, "decoder_model.onnx_data"),
+        os.path.join(ONNX_DIR, "decoder_with_past_model.onnx_data"),
+    ])
 
     log("\n==> Done!")
     log(f"    https://huggingface.co/leks-forever/nllb-200-distilled-600M/tree/main/onnx")
 
 
+def _clone_file(src, dst):
+    """Copy src to dst with copy_file_range, which reflinks (O(1), no bytes
+    copied) on filesystems that support it and copies in-kernel elsewhere.
+    Falls back to shutil.copy2 where the syscall is unavailable or stops
+    short of the end of src."""
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining:
+                n = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+    except (AttributeError, OSError):
+        remaining = -1
+    if remaining:
+        shutil.copy2(src, dst)
+    if os.path.getsize(dst) != os.path.getsize(src):
+        raise IOError(f"short copy of {src} to {dst}")
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """Append src[offset:offset + length] at dst's current position.
+
+    Uses sendfile so the bytes never pass through userspace; falls back to
+    pread/write where sendfile cannot target a regular file (e.g. macOS).
+    """
+    end = offset + length
+    while offset < end:
+        try:
+            n = os.sendfile(dst_fd, src_fd, offset, end - offset)
+        except (AttributeError, OSError):
+            n = os.write(dst_fd, os.pread(src_fd, min(end - offset, 1 << 24), offset))
+        if n == 0:
+            raise IOError(f"unexpected end of file at offset {offset}")
+        offset += n
+
+
 def _kv(key, value):
     from onnx import StringStringEntryProto
     e = StringStringEntryProto()
@@ -7,8 +7,14 @@ Run after convert.py has exported the ONNX files:
 """
 
 import glob
+import multiprocessing
 import os
+import queue
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from quantize_common import model_size, quantize_int8, quantize_workers
 
 MODEL_ID = "leks-forever/nllb-200-distilled-600M-v1"
 ONNX_DIR = "./onnx_export/onnx"
@@ -21,17 +27,41 @@ MODELS_TO_QUANTIZE = [
 ]
 
 
+def _uploader(api, upload_q, errors):
+    """Upload each quantized file as it is handed over, until None arrives."""
+    while True:
+        path = upload_q.get()
+        if path is None:
+            return
+        try:
+            print(f"  Uploading {os.path.basename(path)} ...")
+            api.upload_file(
+                path_or_fileobj=path,
+                path_in_repo=f"onnx/{os.path.basename(path)}",
+                repo_id=MODEL_ID,
+                repo_type="model",
+            )
+        except Exception as e:
+            errors.append(e)
+
+
 def main() -> None:
     print("==> Logging in to HuggingFace...")
     from huggingface_hub import login
     token = os.environ.get("HF_TOKEN")
     login(token=token)
 
+    from huggingface_hub import HfApi
+    api = HfApi()
+
     # Step 1: Quantize each model to int8
+    # Each file is an independent CPU-bound pass, so run them in parallel.
+    # Smallest first, and each finished file is uploaded in the background
+    # while the larger ones are still quantizing.
     print("\n==> Quantizing ONNX models to int8 (_quantized.onnx)...")
-    from onnxruntime.quantization import quantize_dynamic, QuantType
-
-    for fname in MODELS_TO_QUANTIZE:
+    jobs = []
+    for fname in sorted(MODELS_TO_QUANTIZE,
+                        key=lambda f: model_size(os.path.join(ONNX_DIR, f))):
         src = os.path.join(ONNX_DIR, fname)
         stem = fname.replace(".onnx", "")
         dst = os.path.join(ONNX_DIR, f"{stem}_quantized.onnx")
@@ -41,36 +71,48 @@ def main() -> None:
             continue
 
         print(f"  {fname} -> {os.path.basename(dst)}")
-        quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+        jobs.append((src, dst))
+
+    upload_q = queue.Queue()
+    upload_errors = []
+    uploader = threading.Thread(target=_uploader, args=(api, upload_q, upload_errors))
+    uploader.start()
+    uploaded = []
+    try:
+        # spawn, not fork: the uploader thread is already running, and
+        # forking a multi-threaded process can deadlock the child.
+        with ProcessPoolExecutor(max_workers=quantize_workers(len(jobs)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(quantize_int8, src, dst): dst for src, dst in jobs}
+            for fut in as_completed(futures):
+                fut.result()  # re-raise any worker failure
+                upload_q.put(futures[fut])
+                uploaded.append(os.path.basename(futures[fut]))
+    finally:
+        upload_q.put(None)
+        uploader.join()
+    if upload_errors:
+        raise upload_errors[0]
 
     print("\n==> Quantization done. Files:")
     for f in sorted(glob.glob(f"{ONNX_DIR}/*.onnx")):
         size = os.path.getsize(f)
         print(f"  {os.path.basename(f):50s} {size / 1e6:.1f} MB")
 
-    # Step 2: Upload everything to HuggingFace onnx/ subfolder
-    # Upload order: quantized first (smaller), then fp32
+    # Step 2: Upload the rest to HuggingFace onnx/ subfolder
+    # upload_folder hashes and uploads the files concurrently in one commit.
     print(f"\n==> Uploading to {MODEL_ID}/onnx/ ...")
-    from huggingface_hub import HfApi
-    api = HfApi()
 
-    # Collect files to upload: all .onnx and .onnx_data files except the -inferred helper
-    upload_files = []
-    for f in sorted(glob.glob(f"{ONNX_DIR}/*.onnx") + glob.glob(f"{ONNX_DIR}/*.onnx_data")):
-        if "inferred" in os.path.basename(f):
-            continue
-        upload_files.append(f)
-
-    for path in upload_files:
-        fname = os.path.basename(path)
-        size_mb = os.path.getsize(path) / 1e6
-        print(f"  Uploading onnx/{fname} ({size_mb:.0f} MB) ...")
-        api.upload_file(
-            path_or_fileobj=path,
-            path_in_repo=f"onnx/{fname}",
-            repo_id=MODEL_ID,
-            repo_type="model",
-        )
+    # All .onnx and .onnx_data files except the -inferred helper and the
+    # quantized files already uploaded in the background
+    api.upload_folder(
+        folder_path=ONNX_DIR,
+        path_in_repo="onnx",
+        repo_id=MODEL_ID,
+        repo_type="model",
+        allow_patterns=["*.onnx", "*.onnx_data"],
+        ignore_patterns=["*inferred*", "*.pre.onnx*"] + uploaded,
+    )
 
     print(f"\n==> Done!")
     print(f"    https://huggingface.co/{MODEL_ID}/tree/main/onnx")
@@ -0,0 +1,81 @@
+"""
+Quantize helpers shared by convert.py, quantize_and_upload.py and
+merge_and_upload.py.
+"""
+import os
+
+
+def quantize_workers(n_jobs):
+    """Number of quantize processes to run at once.
+
+    Each worker holds a whole model in RAM, so running all files in parallel
+    roughly triples peak memory. Default to sequential below 16 GB of RAM;
+    override with QUANTIZE_WORKERS=N.
+    """
+    override = os.environ.get("QUANTIZE_WORKERS")
+    if override:
+        return max(1, int(override))
+    try:
+        ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        ram = 0
+    return max(1, n_jobs) if ram >= 16e9 else 1
+
+
+def model_size(path):
+    """Size of an ONNX file plus its .onnx_data sidecar, if any."""
+    size = os.path.getsize(path)
+    if os.path.exists(path + "_data"):
+        size += os.path.getsize(path + "_data")
+    return size
+
+
+def quantize_int8(src, dst):
+    """Pre-process and quantize a single ONNX file to int8. Runs in a worker
+    process."""
+    if os.path.exists(dst):
+        return
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # Shape inference + ORT graph fusion before quantizing, so more ops end
+    # up on the MatMulInteger path. ORT's optimizer cannot write models over
+    # 2 GB, so large decoders only get shape inference.
+    pre = os.path.splitext(src)[0] + ".pre.onnx"
+    try:
+        quant_pre_process(
+            src, pre,
+            skip_optimization=model_size(src) >= 2**31,
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            external_data_location=os.path.basename(pre) + "_data",
+        )
+        # Per-channel 7-bit weights: reduce_range avoids the saturation
+        # workaround on CPUs without VNNI. Gather covers the ~1 GB shared
+        # embedding table, which would otherwise stay fp32.
+        quantize_dynamic(pre, dst, weight_type=QuantType.QUInt8,
+                         per_channel=True, reduce_range=True,
+                         op_types_to_quantize=["MatMul", "Gather"])
+    finally:
+        for p in (pre, pre + "_data"):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def quantize_q4(src, dst):
+    """4-bit weight-only quantization of every MatMul (MatMulNBits) and the
+    embedding Gather (GatherBlockQuantized), written as <dst> + <dst>_data.
+    transformers.js loads these for dtype='q4'."""
+    import onnx
+    from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer
+    # MatMul4BitsQuantizer only touches MatMul by default; without Gather the
+    # fp32 embedding table alone outweighs the rest of the q4 model.
+    quant = MatMul4BitsQuantizer(onnx.load(src, load_external_data=True),
+                                 block_size=32, is_symmetric=False, accuracy_level=4,
+                                 op_types_to_quantize=("MatMul", "Gather"),
+                                 quant_axes=(("MatMul", 0), ("Gather", 1)))
+    quant.process()
+    onnx.save_model(quant.model.model, dst,
+                    save_as_external_data=True,
+                    all_tensors_to_one_file=True,
+                    location=os.path.basename(dst) + "_data")
@@ -2,39 +2,115 @@
 Generates tokenizer.json (fast tokenizer) from the SentencePiece model
 and uploads all tokenizer files to the HF repo root.
 """
+import hashlib
 import os
-from huggingface_hub import login, HfApi
+from concurrent.futures import ThreadPoolExecutor
 
 MODEL_ID = "leks-forever/nllb-200-distilled-600M-v1"
 OUT_DIR = "./tokenizer_out"
 
 
+def file_hash(path, lfs):
+    """Hash of a local file as the Hub reports it: sha256 for LFS files,
+    the git blob sha1 otherwise."""
+    h = hashlib.sha256() if lfs else hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_unchanged(path, info):
+    """True if the local file matches the repo's copy (a RepoFile)."""
+    if info.lfs is not None:
+        return file_hash(path, lfs=True) == info.lfs.sha256
+    return file_hash(path, lfs=False) == info.blob_id
+
+
+def pooled_session():
+    """huggingface_hub's default session with a larger keep-alive pool.
+
+    Retries are left to huggingface_hub's own http_backoff. The adapters
+    are private to huggingface_hub, hence its <1.0 bound in pyproject.toml.
+    """
+    import requests
+    from huggingface_hub import constants
+    from huggingface_hub.utils._http import OfflineAdapter, UniqueRequestIdAdapter
+    session = requests.Session()
+    if constants.HF_HUB_OFFLINE:
+        adapter = OfflineAdapter()
+    else:
+        adapter = UniqueRequestIdAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def main():
+    # Let hf_xet use more threads/memory for the upload (read when it starts).
+    os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+    # Rust multi-part uploader for the multi-MB tokenizer.json on non-xet
+    # repos. huggingface_hub reads this at import time, so set it first.
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+    from huggingface_hub import configure_http_backend, login, HfApi
+    from huggingface_hub.hf_api import RepoFile
+    configure_http_backend(backend_factory=pooled_session)
     token = os.environ.get("HF_TOKEN")
     login(token=token)
 
     os.makedirs(OUT_DIR, exist_ok=True)
 
+    # List the repo root in the background while the tokenizer loads and
+    # saves; the skip check below needs it only once the files are on disk.
+    api = HfApi()
+    lister = ThreadPoolExecutor(max_workers=1)
+    remote_future = lister.submit(lambda: {
+        info.path: info
+        for info in api.list_repo_tree(MODEL_ID, repo_type="model")
+        if isinstance(info, RepoFile)
+    })
+    lister.shutdown(wait=False)
+
     print("==> Loading fast tokenizer...")
-    from transformers import AutoTokenizer
-    tok = AutoTokenizer.from_pretrained(MODEL_ID, use_fast=True)
+    # NllbTokenizerFast directly: importing it skips transformers' auto-class
+    # mappings (~1 s), it loads tokenizer.json directly when the repo has one
+    # (the SentencePiece conversion only runs when it is missing), and it
+    # keeps tokenizer_class = "NllbTokenizer" in the saved
+    # tokenizer_config.json, which transformers.js needs for the
+    # language-code handling.
+    from transformers import NllbTokenizerFast
+    tok = NllbTokenizerFast.from_pretrained(MODEL_ID)
     tok.save_pretrained(OUT_DIR)
 
     print("\n==> Saved files:")
-    for f in sorted(os.listdir(OUT_DIR)):
-        size = os.path.getsize(os.path.join(OUT_DIR, f))
-        print(f"  {f}  ({size / 1e3:.1f} kB)")
+    with os.scandir(OUT_DIR) as it:
+        entries = sorted((e for e in it if e.is_file()), key=lambda e: e.name)
+    for e in entries:
+        print(f"  {e.name}  ({e.stat().st_size / 1e3:.1f} kB)")
 
     print(f"\n==> Uploading tokenizer files to {MODEL_ID} root...")
-    api = HfApi()
-    for fname in sorted(os.listdir(OUT_DIR)):
-        path = os.path.join(OUT_DIR, fname)
-        print(f"  Uploading {fname} ...")
-        api.upload_file(
-            path_or_fileobj=path,
-            path_in_repo=fname,
+    files = [e.name for e in entries]
+    remote = remote_future.result()
+    # Hash the files that exist remotely concurrently; hashlib releases
+    # the GIL on large reads, so threads are enough.
+    on_hub = [f for f in files if f in remote]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(on_hub), os.cpu_count() or 1))) as ex:
+        same = dict(zip(on_hub, ex.map(
+            lambda f: is_unchanged(os.path.join(OUT_DIR, f), remote[f]), on_hub)))
+    changed = [f for f in files if not same.get(f, False)]
+    for f in files:
+        if f not in changed:
+            print(f"  {f} unchanged, skipping")
+
+    if changed:
+        # One commit for all files; upload_folder batches the preupload calls
+        # and, on xet-backed repos, skips chunks the Hub already has.
+        api.upload_folder(
+            folder_path=OUT_DIR,
             repo_id=MODEL_ID,
             repo_type="model",
+            allow_patterns=changed,
+            commit_message="Upload tokenizer",
         )
 
     print("\n==> Done!")